@@ -5,10 +5,13 @@ Attributes:
 
 """
 
+import copy
 import datetime as dt
 import itertools
 import random
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 import astropy.units as units
 import numpy as np
@@ -23,11 +26,6 @@ from coord import CRD
 Pair = namedtuple('Pair', 'x y')
 
 psy.extensions.register_adapter(np.float32, psy._psycopg.AsIs)
-DEC2FLOAT = psy.extensions.new_type(
-    psy.extensions.DECIMAL.values,
-    'DEC2FLOAT',
-    lambda value, curs: float(value) if value is not None else None)
-psy.extensions.register_type(DEC2FLOAT)
 
 __authors__ = ["Zach Werginz", "Andrés Muñoz-Jaramillo"]
 __email__ = ["zachary.werginz@snc.edu", "amunozj@gsu.edu"]
@@ -36,7 +34,9 @@ __email__ = ["zachary.werginz@snc.edu", "amunozj@gsu.edu"]
 def get_file_list(i1, i2, tol1, tol2):
     """Returns a list of valid file combinations.
 
-    Searches for files within tol1 of each other as a lower bound or tol2 as an upper bound.
+    Searches for files within tol1 of each other as a lower bound or tol2 as an upper bound. Results are cached per
+    query, so a fresh list is returned each call for callers that remove matches as they go. Rows added to
+    file_time_diff afterwards are not seen; call _query_file_list.cache_clear() to query the database again.
 
     Args:
         i1 (str): reference instrument
@@ -48,6 +48,12 @@ def get_file_list(i1, i2, tol1, tol2):
         list: list of filename pairs that satisfy the condition in tuple form (file1, file2)
 
     """
+    return list(_query_file_list(i1.upper(), i2.upper(), tol1, tol2))
+
+
+@lru_cache(maxsize=32)
+def _query_file_list(i1, i2, tol1, tol2):
+    """Query the database for file pairs between two instruments and return them as a tuple."""
     instrument_key = {'512': 1, 'SPMG': 2, 'MDI': 3, 'HMI': 4, 'SIM': 5, 'SIM2': 6}
 
     conn = u.load_database()
@@ -58,17 +64,47 @@ def get_file_list(i1, i2, tol1, tol2):
                 JOIN file b ON main.file2 = b.id \
                 WHERE a.instrument = %s AND b.instrument = %s \
                 AND difference BETWEEN INTERVAL %s \
-                AND INTERVAL %s;", (instrument_key[i1.upper()],
-                                    instrument_key[i2.upper()], tol1, tol2))
+                AND INTERVAL %s;", (instrument_key[i1], instrument_key[i2], tol1, tol2))
 
-    results = cur.fetchall()
+    results = tuple(cur.fetchall())
     cur.close()
     conn.close()
 
     return results
 
 
-def prepare_magnetograms(f1, f2, raw_remap=False, downscale=False):
+def _read_crd(filename):
+    """Return a magnetogram with coordinates, pixel area and corrected field calculated."""
+    mgnt = CRD(filename)
+    mgnt.heliographic()
+    mgnt.eoa()
+    mgnt.los_corr()
+    return mgnt
+
+
+@lru_cache(maxsize=2)
+def _load_crd(filename):
+    """Return _read_crd(filename), cached by filepath."""
+    return _read_crd(filename)
+
+
+def clear_magnetogram_cache():
+    """Release the magnetograms kept by prepare_magnetograms(cache=True)."""
+    _load_crd.cache_clear()
+
+
+def _copy_crd(filename):
+    """Return a shallow copy of a cached magnetogram that owns its heliographic arrays.
+
+    Fragmentation masks lonh and lath in place, so those are copied to keep the cached object intact.
+    """
+    mgnt = copy.copy(_load_crd(filename))
+    mgnt.lonh = mnp.Measurement(mgnt.lonh.v.copy(), mgnt.lonh.u.copy())
+    mgnt.lath = mnp.Measurement(mgnt.lath.v.copy(), mgnt.lath.u.copy())
+    return mgnt
+
+
+def prepare_magnetograms(f1, f2, raw_remap=False, downscale=False, cache=False):
     """Calculate heliographic information and apply differential rotation.
 
     The standard is to interpolate the smaller resolution magnetogram into the larger one unless downscale is chosen.
@@ -78,6 +114,7 @@ def prepare_magnetograms(f1, f2, raw_remap=False, downscale=False):
         f2 (str): the second file
         raw_remap (bool): defaults to False, uses raw flux density instead of corrected one
         downscale (bool): defaults to False, will downscale larger resolution to smaller one
+        cache (bool): defaults to False, keeps the last two processed files for reuse until clear_magnetogram_cache
 
     Returns:
         object: returns m1 and m2 as a tuple with rotations applied
@@ -85,27 +122,35 @@ def prepare_magnetograms(f1, f2, raw_remap=False, downscale=False):
     """
     print(f1)
     print(f2)
-    mgnt1 = CRD(f1)
-    mgnt2 = CRD(f2)
+    if cache:
+        mgnt1 = _copy_crd(f1)
+        mgnt2 = _copy_crd(f2)
+    else:
+        mgnt1 = _read_crd(f1)
+        mgnt2 = _read_crd(f2)
     print(mgnt1.im_raw.date)
     print(mgnt2.im_raw.date)
-    mgnt1.heliographic()
-    mgnt2.heliographic()
     mgnt1.magnetic_flux()
     mgnt2.magnetic_flux()
     # Apply differential Rotation
     if mgnt2.im_raw.dimensions[0].value > mgnt1.im_raw.dimensions[0].value and not downscale:
         rotation = u.diff_rot(mgnt2, mgnt1)
-        mgnt1.lonhRot = mgnt1.lonh + rotation.value
+        mgnt1.lonhRot = _rotate_longitude(mgnt1.lonh, rotation)
         interpolate_remap(mgnt2, mgnt1, raw_remap)
         return mgnt2, mgnt1
     else:
         rotation = u.diff_rot(mgnt1, mgnt2)
-        mgnt2.lonhRot = mgnt2.lonh + rotation.value
+        mgnt2.lonhRot = _rotate_longitude(mgnt2.lonh, rotation)
         interpolate_remap(mgnt1, mgnt2, raw_remap)
         return mgnt1, mgnt2
 
 
+def _rotate_longitude(lonh, rotation):
+    """Return lonh shifted by a differential rotation, reusing the rotation array as the output buffer."""
+    rotated = np.add(lonh.v, rotation.value, out=rotation.value)
+    return mnp.Measurement(rotated, lonh.u)
+
+
 def interpolate_remap(m1, m2, raw=False):
     """Perform interpolation of m2 into coordinate system of m1.
 
@@ -126,10 +171,11 @@ def interpolate_remap(m1, m2, raw=False):
     y1 = m1.lath.v.flatten()
     dim1 = m1.im_raw.dimensions
 
-    latitude_mask2 = np.where(np.abs(y2) < 50)
-    latitude_mask1 = np.where(np.abs(y1) < 50)
-    minimum = max(np.nanmin(x2[latitude_mask2]), np.nanmin(x1[latitude_mask1]))
-    maximum = min(np.nanmax(x2[latitude_mask2]), np.nanmax(x1[latitude_mask1]))
+    # Index the low latitude longitudes once per image and reuse them for both bounds.
+    lon2 = x2[np.abs(y2) < 50]
+    lon1 = x1[np.abs(y1) < 50]
+    minimum = max(np.nanmin(lon2), np.nanmin(lon1))
+    maximum = min(np.nanmax(lon2), np.nanmax(lon1))
 
     ind2 = (np.isfinite(x2) * np.isfinite(y2) * np.isfinite(v2) * (x2 > minimum) * (x2 < maximum))
     ind1 = (np.isfinite(x1) * np.isfinite(y1) * (x1 > minimum) * (x1 < maximum))
@@ -143,18 +189,43 @@ def interpolate_remap(m1, m2, raw=False):
     m2.remap = new_m2
 
 
-def run_multiple_n(mgnt):
-    """Takes mgnt and returns list of different fragmented quadrangles."""
-    n_list = [i for i in range(10, 3100, 100)]
+def run_multiple_n(mgnt, workers=4):
+    """Takes mgnt and returns the number of fragmented quadrangles for a range of fragmentation parameters.
+
+    The parameters are split across worker processes since fragment_single modifies mgnt. Each worker receives its own
+    copy of mgnt once at startup, so keep workers small for full disk magnetograms.
+
+    Args:
+        mgnt (obj): CRD object with heliographic information
+        workers (int, optional): number of worker processes, defaults to 4
 
-    n_dict_length = {}
+    Returns:
+        dict: number of quadrangles keyed by fragmentation parameter
+
+    """
+    n_list = range(10, 3100, 100)
 
-    for n in n_list:
-        num_blocks = quad.fragment_single(m, n)
-        n_dict_length[n] = len(num_blocks)
+    # Tasks are handed out one n at a time so the costly large n values spread across the workers.
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(mgnt,)) as executor:
+        n_dict_length = dict(zip(n_list, executor.map(_count_blocks, n_list)))
     return n_dict_length
 
 
+# Magnetogram shared by all tasks of a run_multiple_n worker process.
+_worker_mgnt = None
+
+
+def _init_worker(mgnt):
+    """Store the magnetogram for the tasks of this worker process."""
+    global _worker_mgnt
+    _worker_mgnt = mgnt
+
+
+def _count_blocks(n):
+    """Fragment the worker magnetogram with parameter n and return the number of quadrangles."""
+    return len(quad.fragment_single(_worker_mgnt, n))
+
+
 def upload_quadrangles(conn, b, working_files, sim=False):
     """Upload the fragmentation information to the postgres database.
 
@@ -267,7 +338,7 @@ def prepare_simulation(fn1, fn2):
     sim1 = MockCRD(fn1)
     sim2 = MockCRD(fn2)
     rotation = u.diff_rot(sim2, sim1)
-    sim2.lonhRot = sim1.lonh + rotation.value
+    sim2.lonhRot = _rotate_longitude(sim1.lonh, rotation)
     interpolate_remap(sim1, sim2, False)
     sim2.remap = sim2.im_raw.data
 
@@ -350,7 +421,7 @@ def analyze_random_sample(i1, i2, tol1, tol2, n=25, passes=1, upload=False, uniq
     file_matches = get_file_list(i1, i2, tol1, tol2)
     conn = u.load_database()
     blocks_list = []
-    day_matches = []
+    day_matches = set()
     i = 0
     while True:
         if i > passes:
@@ -379,7 +450,7 @@ def analyze_random_sample(i1, i2, tol1, tol2, n=25, passes=1, upload=False, uniq
                         del file_matches[choice_int]
                         continue
                     else:
-                        day_matches.append((day1.toordinal(), day2.toordinal()))
+                        day_matches.add((day1.toordinal(), day2.toordinal()))
 
                 cur.close()
                 blocks = compare_day(i1, i2, working_files[0], working_files[1], n)
@@ -10,25 +10,17 @@ Attributes:
 """
 
 import datetime as dt
-import glob
-import os.path
-import pickle
+import fnmatch
+import io
+import os
+from functools import lru_cache
 
 import astropy.units as u
 import numpy as np
 import psycopg2 as psy
-import sunpy.physics.differential_rotation as d
-import sunpy.time
 from astropy.io import fits
 
-from coord import CRD
-
 psy.extensions.register_adapter(np.float32, psy._psycopg.AsIs)
-DEC2FLOAT = psy.extensions.new_type(
-    psy.extensions.DECIMAL.values,
-    'DEC2FLOAT',
-    lambda value, curs: np.float32(value) if value is not None else None)
-psy.extensions.register_type(DEC2FLOAT)
 
 __authors__ = ["Zach Werginz", "Andrés Muñoz-Jaramillo"]
 __email__ = ["zachary.werginz@snc.edu", "amunozj@gsu.edu"]
@@ -36,7 +28,14 @@ __email__ = ["zachary.werginz@snc.edu", "amunozj@gsu.edu"]
 data_root = 'H:'
 debug = False
 
+# Layout of one COPY ... (FORMAT binary) tuple holding three non-null float4 columns.
+_quadrangle_row = np.dtype([('fields', '>i2'),
+                            ('len_ref', '>i4'), ('reference_fd', '>f4'),
+                            ('len_sec', '>i4'), ('secondary_fd', '>f4'),
+                            ('len_da', '>i4'), ('disk_angle', '>f4')])
+
 
+@lru_cache(maxsize=None)
 def date_offset(instr):
     """Returns a datetime object of the instrument start year."""
     if instr == 'spmg':
@@ -81,34 +80,36 @@ def download_cc_data(i1, i2, n, tol1, tol2):
         'secondaryFD': array([...]), 'timeDifference': datetime.timedelta(1)}
     """
     conn = load_database()
-    cur = conn.cursor("server_side")
-    fetchlimit = 10000000
+    cur = conn.cursor()
 
     instrument_key = {'512': 1, 'SPMG': 2, 'MDI': 3, 'HMI': 4, 'SIM': 5, 'SIM2': 6}
-    
+
     result = {}
-    points = [0]
-    x = []
-    y = []
-    da = []
-    cur.execute("SELECT referencefluxdensity, secondaryfluxdensity, diskangle \
+    query = cur.mogrify("SELECT referencefluxdensity::real, secondaryfluxdensity::real, diskangle::real \
                     FROM quadrangle q JOIN file a ON q.referencemag = a.id \
                     JOIN file b ON q.secondarymag = b.id \
                     WHERE fragmentationvalue = %s \
                     AND a.instrument = %s AND b.instrument = %s \
                     AND age(b.date, a.date) BETWEEN  INTERVAL %s AND  INTERVAL %s",
-                (n, instrument_key[i1.upper()], instrument_key[i2.upper()], tol1, tol2))
+                        (n, instrument_key[i1.upper()], instrument_key[i2.upper()], tol1, tol2))
 
-    while points:
-        points = cur.fetchmany(fetchlimit)
-        x.extend([s[0] for s in points])
-        y.extend([s[1] for s in points])
-        da.extend([np.float32(s[2]) for s in points])
+    # Stream the rows in binary so they are read straight into numpy without building Python tuples.
+    buf = io.BytesIO()
+    cur.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT binary)".format(query.decode()), buf)
     cur.close()
 
-    result['reference_fd'] = np.array(x)
-    result['secondary_fd'] = np.array(y)
-    result['disk_angle'] = np.array(da)
+    # View the buffer in place; the row count follows from its size, so no count query is needed.
+    raw = buf.getbuffer()
+    # Skip the 11 byte signature, 4 byte flags and the header extension, and drop the 2 byte trailer.
+    offset = 19 + int.from_bytes(raw[15:19], 'big')
+    count, remainder = divmod(len(raw) - offset - 2, _quadrangle_row.itemsize)
+    rows = np.frombuffer(raw, dtype=_quadrangle_row, count=count, offset=offset)
+    if remainder or np.any((rows['len_ref'] != 4) | (rows['len_sec'] != 4) | (rows['len_da'] != 4)):
+        raise ValueError('Unexpected NULL values in quadrangle data')
+
+    result['reference_fd'] = rows['reference_fd'].astype(np.float32)
+    result['secondary_fd'] = rows['secondary_fd'].astype(np.float32)
+    result['disk_angle'] = rows['disk_angle'].astype(np.float32)
     result['i1'] = i1
     result['i2'] = i2
     result['n'] = n
@@ -123,6 +124,7 @@ def download_cc_data(i1, i2, n, tol1, tol2):
     return result
 
 
+@lru_cache(maxsize=None)
 def date_defaults(instr):
     """Returns a tuple pair of dates denoting the start and end dates of the instrument files."""
     if instr == '512':
@@ -156,6 +158,9 @@ def load_sim(fn):
 def search_file(date, instr, auto=True):
     """Searches for a file with a given date and instrument and returns a list of filepaths.
 
+    Directory listings are cached; call _scan_directory.cache_clear() if files are added to an existing directory
+    while running. Missing directories are not cached, so they are found once they are created.
+
     Args:
         date (str) (obj): date of desired file - datetime or str
         instr (str): instrument of desired file
@@ -165,6 +170,8 @@ def search_file(date, instr, auto=True):
         list: list of files or singular file
 
     """
+    import sunpy.time
+
     if not isinstance(date, dt.datetime):
         date = sunpy.time.parse_time(date)
     # Set defaults
@@ -196,8 +203,9 @@ def search_file(date, instr, auto=True):
         raise ValueError('Unrecognized instrument')
 
     # Execute
-    searchspec = os.path.join(data_root, fn0, subdir, filename)
-    files = glob.glob(searchspec)
+    searchdir = os.path.join(data_root, fn0, subdir)
+    searchspec = os.path.join(searchdir, filename)
+    files = [os.path.join(searchdir, x) for x in fnmatch.filter(_list_directory(searchdir), filename)]
 
     pdebug('searchspec: ' + searchspec)
 
@@ -212,6 +220,20 @@ def search_file(date, instr, auto=True):
         return files
 
 
+def _list_directory(directory):
+    """Returns the non-hidden entries of a directory, or an empty tuple if it cannot be read."""
+    try:
+        return _scan_directory(directory)
+    except OSError:
+        return ()
+
+
+@lru_cache(maxsize=None)
+def _scan_directory(directory):
+    """Returns the non-hidden entries of an existing directory, cached by path."""
+    return tuple(x.name for x in os.scandir(directory) if not x.name.startswith('.'))
+
+
 def mdi_file_choose(f):
     """Chooses the best file from a MDI mission day based on missing values and timing interval.
 
@@ -227,25 +249,26 @@ def mdi_file_choose(f):
     mv = 100000
     for x in f:     # but try to find a better match
         pdebug("mdi_file_choose - option: " + x)
-        m = fits.open(x, mode='update')
-        if 'INSTRUME' not in m[0].header.keys():
-            m[0].header.set('instrume', 'MDI')
-            m.flush()
+        header = fits.getheader(x, 0)
+        if 'INSTRUME' not in header:
+            with fits.open(x, mode='update') as m:
+                m[0].header.set('instrume', 'MDI')
         try:
-            intv = m[0].header['INTERVAL']
+            intv = header['INTERVAL']
             if intv == '':
                 intv = 0
             else:
                 intv = int(intv)
             if intv >= ival:
-                if int(m[0].header['MISSVALS']) < mv:
+                if int(header['MISSVALS']) < mv:
                     best = x
-                    ival = m[0].header['INTERVAL']
-                    mv = m[0].header['MISSVALS']
+                    ival = header['INTERVAL']
+                    mv = header['MISSVALS']
         except KeyError:
             continue
-        finally:
-            m.close()
+        # No later file can improve on a magnetogram without missing values.
+        if mv == 0:
+            break
 
     pdebug("mdi_file_choose - selected: " + best)
     return best
@@ -268,11 +291,14 @@ def diff_rot(m1, m2):
         rotation: rotation array containing values to add to longitude
 
     """
+    import sunpy.physics.differential_rotation as d
+
     time_diff = u.Quantity(
             (m1.im_raw.date - m2.im_raw.date).total_seconds(), 'second')
     rotation = d.diff_rot(time_diff, m2.lath.v*u.deg, rot_type='snodgrass', frame_time='synodic')
 
-    if np.nanmean(rotation).value > 90:
+    # A coarse subsample of the latitude grid is enough to detect a full turn of wrapping.
+    if np.nanmean(rotation.value[::32, ::32]) > 90:
         rotation -= 360*u.deg
 
     return rotation
@@ -106,11 +106,12 @@ def create_variable_time_plot(instr):
         if instr == 'sim':
             m1, m2 = c.prepare_simulation(files[0], file)
         else:
-            m1, m2 = c.prepare_magnetograms(files[0], file)
+            m1, m2 = c.prepare_magnetograms(files[0], file, cache=True)
         x = m2.remap.ravel()
         y = m1.im_corr.v.ravel()
         ccplot.scatter_density(x, y, ax, lim=lim, null_cond=cond, log_vmax=200)
         ccplot.add_identity(ax, color='.5', ls='-', alpha=.5, linewidth=2, zorder=1)
+    c.clear_magnetogram_cache()
 
     for ax, letter in zip(f.get_axes(), times):
         ax.annotate(